@@ -1,40 +1,119 @@
+import os
+import hashlib
 import logging
 import imagehash
 
+from io import BytesIO
 from pathlib import Path
+from threading import BoundedSemaphore
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 
 class DuplicateFinder:
-    def __init__(self):
+    def __init__(self, ioWorkers: int = 4, cpuWorkers: int = None, maxPending: int = None, cacheSize: int = 4):
+        """
+        :param ioWorkers: int 读取文件的线程数, 机械硬盘/NAS建议调小
+        :param cpuWorkers: int 解码计算哈希的线程数, 默认为CPU核心数
+        :param maxPending: int 已读入内存但未计算完的文件数上限, 为None时按当前cpuWorkers * 3计算
+        :param cacheSize: int 保留最近对比结果的数量
+        """
         self.hashMap = {
             'phash': imagehash.phash,
             'dhash': imagehash.dhash,
             'whash': imagehash.whash
         }
+        self.ioWorkers = ioWorkers
+        self.cpuWorkers = cpuWorkers or os.cpu_count() or 1
+        self.maxPending = maxPending
+        self.cacheSize = cacheSize
+        self.resultCache = OrderedDict()
 
-    def calcHash(self, imagePath: str | Path, hashMethod='phash', hashSize: int = 8):
+    def readFile(self, imagePath: str | Path):
         try:
-            img = Image.open(imagePath)
-            hashFunc = self.hashMap[hashMethod]
-            return str(imagePath), hashFunc(img, hash_size=hashSize)
+            return str(imagePath), Path(imagePath).read_bytes()
+        except Exception as e:
+            logging.error(f"Error reading {imagePath}: {str(e)}")
+            return str(imagePath), None
+
+    def calcHash(self, imagePath: str | Path, hashMethod='phash', hashSize: int = 8, imageData: bytes = None):
+        try:
+            with Image.open(BytesIO(imageData) if imageData is not None else imagePath) as img:
+                hashFunc = self.hashMap[hashMethod]
+                return str(imagePath), hashFunc(img, hash_size=hashSize)
         except Exception as e:
             logging.error(f"Error processing {imagePath}: {str(e)}")
             return str(imagePath), None
 
-    def calcHashes(self, imageDir: str | Path, hashMethod='phash', hashSize: int = 8, isDeepSeek: bool = False):
-        """多线程批量生成哈希字典"""
-        hashes = {}
+    @staticmethod
+    def diskOrder(path: Path):
+        """按目录和inode排序以便顺序读取磁盘"""
+        try:
+            return str(path.parent), path.stat().st_ino
+        except OSError:
+            return str(path.parent), 0
+
+    def listImages(self, imageDir: str | Path, isDeepSeek: bool = False, sortByDisk: bool = True):
         pathList = [p for p in (Path(imageDir).rglob("*") if isDeepSeek else Path(imageDir).glob("*")) if p.suffix.lower() in {'.jpg', '.png', '.jpeg'}]
-        with ThreadPoolExecutor() as executor:
-            batchSize = executor._max_workers * 3
-            for i in range(0, len(pathList), batchSize):
-                futures = [executor.submit(self.calcHash, path, hashMethod, hashSize) for path in pathList[i:i + batchSize]]
-                for future in futures:
-                    path, h = future.result()
-                    if h is not None:
-                        hashes[path] = h
+        return sorted(pathList, key=self.diskOrder) if sortByDisk else pathList
+
+    def calcHashes(self, imageDir: str | Path, hashMethod='phash', hashSize: int = 8, isDeepSeek: bool = False,
+                   ioWorkers: int = None, cpuWorkers: int = None, maxPending: int = None):
+        """
+        两阶段流水线批量生成哈希字典: I/O线程按顺序读取文件字节, CPU线程从内存解码计算哈希
+        :param imageDir: str | Path 图片目录
+        :param hashMethod: str 哈希算法
+        :param hashSize: int 哈希尺寸
+        :param isDeepSeek: bool 是否检查深层目录
+        :param ioWorkers: int 读取文件的线程数, 默认使用实例设置
+        :param cpuWorkers: int 计算哈希的线程数, 默认使用实例设置
+        :param maxPending: int 内存中待计算文件数上限(背压), 默认使用实例设置
+        :return: Dict[str, ImageHash] 哈希字典
+        """
+        return self.calcPathHashes(self.listImages(imageDir, isDeepSeek), hashMethod, hashSize, ioWorkers, cpuWorkers, maxPending)
+
+    def calcPathHashes(self, pathList: list, hashMethod='phash', hashSize: int = 8,
+                       ioWorkers: int = None, cpuWorkers: int = None, maxPending: int = None):
+        """按给定顺序对文件列表执行两阶段流水线哈希计算"""
+        hashes = {}
+        cpuWorkers = cpuWorkers or self.cpuWorkers
+        pending = BoundedSemaphore(maxPending or self.maxPending or cpuWorkers * 3)
+
+        with ThreadPoolExecutor(cpuWorkers, thread_name_prefix="hashCPU") as cpuExecutor, \
+                ThreadPoolExecutor(ioWorkers or self.ioWorkers, thread_name_prefix="hashIO") as ioExecutor:
+
+            def readStage(imagePath):
+                # 未交给CPU阶段的文件都要释放占用的缓冲名额, 否则生产者会一直阻塞
+                try:
+                    path, data = self.readFile(imagePath)
+                    if data is None:
+                        pending.release()
+                        return None
+                    future = cpuExecutor.submit(self.calcHash, path, hashMethod, hashSize, data)
+                except BaseException:
+                    pending.release()
+                    raise
+                future.add_done_callback(lambda _: pending.release())
+                return future
+
+            ioFutures = []
+            for path in pathList:
+                # 内存中的待计算文件达到上限时阻塞, 等待CPU阶段消化
+                pending.acquire()
+                try:
+                    ioFutures.append(ioExecutor.submit(readStage, path))
+                except BaseException:
+                    pending.release()
+                    raise
+
+            for ioFuture in ioFutures:
+                cpuFuture = ioFuture.result()
+                if cpuFuture is None:
+                    continue
+                path, h = cpuFuture.result()
+                if h is not None:
+                    hashes[path] = h
         return hashes
 
     def findDuplicate(self, hashes, threshold=12, fullMatch=False):
@@ -43,7 +122,7 @@ class DuplicateFinder:
         :param hashes: Dict[str, ImageHash] 哈希字典
         :param threshold: int 汉明距离阈值
         :param fullMatch: bool 是否进行全量对比
-        :return: Dict[str, List[Tuple[str, float]]] 重复项字典
+        :return: Dict[str, List[Tuple[str, float, int]]] 重复项字典(对比路径, 相似度, 汉明距离)
         """
         duplicates = {}
         hashItems = list(hashes.items())
@@ -57,7 +136,7 @@ class DuplicateFinder:
                 distance = baseHash - compareHash
                 if distance <= threshold:
                     similarity = 1 - distance / (len(baseHash.hash) ** 2)
-                    matches.append((comparePath, round(similarity, 2)))
+                    matches.append((comparePath, round(similarity, 2), distance))
             return basePath, matches
 
         with ThreadPoolExecutor() as executor:
@@ -73,7 +152,7 @@ class DuplicateFinder:
         :param baseHashes: Dict[str, ImageHash] 基准哈希字典
         :param compareHash: Dict[str, ImageHash] 待对比哈希字典
         :param threshold: int 汉明距离阈值
-        :return: Dict[str, List[Tuple[str, float]]] 重复项字典
+        :return: Dict[str, List[Tuple[str, float, int]]] 重复项字典(对比路径, 相似度, 汉明距离)
         """
         duplicates = {}
         baseItems = list(baseHashes.items())
@@ -86,7 +165,7 @@ class DuplicateFinder:
                 distance = baseHash - compareHash
                 if distance <= threshold:
                     similarity = 1 - distance / (len(baseHash.hash) ** 2)
-                    matches.append((comparePath, round(similarity, 2)))
+                    matches.append((comparePath, round(similarity, 2), distance))
             return basePath, matches
 
         with ThreadPoolExecutor() as executor:
@@ -95,3 +174,120 @@ class DuplicateFinder:
                 if matches:
                     duplicates[basePath] = matches
         return duplicates
+
+    def calcMultiHashes(self, imageDirs: list, hashMethod='phash', hashSize: int = 8, isDeepSeek: bool = False,
+                        ioWorkers: int = None, cpuWorkers: int = None, maxPending: int = None):
+        """
+        一次流水线计算多个目录的哈希, 重叠目录中的文件只计算一次并归属于最深的目录
+        :param imageDirs: List[str | Path] 目录列表
+        :param hashMethod: str 哈希算法
+        :param hashSize: int 哈希尺寸
+        :param isDeepSeek: bool 是否检查深层目录
+        :param ioWorkers: int 读取文件的线程数, 默认使用实例设置
+        :param cpuWorkers: int 计算哈希的线程数, 默认使用实例设置
+        :param maxPending: int 内存中待计算文件数上限(背压), 默认使用实例设置
+        :return: Tuple[Dict[str, ImageHash], Dict[str, str]] 哈希字典, 文件所属目录字典
+        """
+        pathList, sourceRoots, _ = self.scanImages(imageDirs, isDeepSeek)
+        hashes = self.calcPathHashes(pathList, hashMethod, hashSize, ioWorkers, cpuWorkers, maxPending)
+        return hashes, {path: sourceRoots[path] for path in hashes}
+
+    def findMultiDuplicates(self, hashes, sourceRoots, threshold=12, intraMatch=False):
+        """
+        多线程对比多个目录的合并哈希集合, 每对图片只比对一次
+        :param hashes: Dict[str, ImageHash] 合并后的哈希字典
+        :param sourceRoots: Dict[str, str] 文件所属目录字典
+        :param threshold: int 汉明距离阈值
+        :param intraMatch: bool 是否同时对比同一目录内的图片
+        :return: Dict[str, List[Tuple[str, float, int]]] 重复项字典(对比路径, 相似度, 汉明距离)
+        """
+        duplicates = {}
+        hashItems = list(hashes.items())
+        rootItems = [sourceRoots[path] for path, _ in hashItems]
+
+        def compareHashes(index):
+            basePath, baseHash = hashItems[index]
+            baseRoot = rootItems[index]
+            matches = []
+            for num in range(index + 1, len(hashItems)):
+                if not intraMatch and rootItems[num] == baseRoot:
+                    continue
+                comparePath, compareHash = hashItems[num]
+                distance = baseHash - compareHash
+                if distance <= threshold:
+                    similarity = 1 - distance / (len(baseHash.hash) ** 2)
+                    matches.append((comparePath, round(similarity, 2), distance))
+            return basePath, matches
+
+        with ThreadPoolExecutor() as executor:
+            results = executor.map(compareHashes, range(len(hashItems)))
+            for basePath, matches in results:
+                if matches:
+                    duplicates[basePath] = matches
+        return duplicates
+
+    def scanImages(self, imageDirs: list, isDeepSeek: bool = False):
+        """
+        扫描多个目录, 每个文件只stat一次, 同时得到按磁盘顺序排列的文件列表、所属目录和用于判断缓存是否失效的摘要
+        重叠目录中的文件只保留一次并归属于最深的目录
+        :param imageDirs: List[str | Path] 目录列表
+        :param isDeepSeek: bool 是否检查深层目录
+        :return: Tuple[List[Path], Dict[str, str], str] 文件列表, 文件所属目录字典, 摘要
+        """
+        # 统一解析目录, 避免软链接或相对路径导致同一文件被重复计算
+        rootDirs = sorted({Path(imageDir).resolve() for imageDir in imageDirs}, key=lambda d: (-len(d.parts), str(d)))
+        entries = {}
+        for rootDir in rootDirs:
+            for path in self.listImages(rootDir, isDeepSeek, sortByDisk=False):
+                if str(path) in entries:
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries[str(path)] = (path, str(rootDir), stat)
+
+        digest = hashlib.sha1()
+        for key in sorted(entries):
+            stat = entries[key][2]
+            digest.update(f"{key}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+        ordered = sorted(entries.values(), key=lambda entry: (str(entry[0].parent), entry[2].st_ino))
+        return [entry[0] for entry in ordered], {str(entry[0]): entry[1] for entry in ordered}, digest.hexdigest()
+
+    def getCachedResult(self, cacheKey: tuple, fingerprint: str, maxRadius: int):
+        """
+        读取缓存的对比结果, 缓存的半径可能大于maxRadius, 需配合filterDuplicates使用
+        :param cacheKey: tuple 对比模式、目录和哈希设置
+        :param fingerprint: str 图片摘要
+        :param maxRadius: int 需要的最大汉明距离
+        :return: 缓存的对比结果, 缓存失效时返回None
+        """
+        cached = self.resultCache.get(cacheKey)
+        if cached is None:
+            return None
+        cachedFingerprint, cachedRadius, result = cached
+        if cachedFingerprint != fingerprint or cachedRadius < maxRadius:
+            return None
+        self.resultCache.move_to_end(cacheKey)
+        return result
+
+    def setCachedResult(self, cacheKey: tuple, fingerprint: str, maxRadius: int, result):
+        self.resultCache[cacheKey] = (fingerprint, maxRadius, result)
+        self.resultCache.move_to_end(cacheKey)
+        while len(self.resultCache) > self.cacheSize:
+            self.resultCache.popitem(last=False)
+
+    @staticmethod
+    def filterDuplicates(duplicates, threshold):
+        """
+        按汉明距离阈值重新筛选对比结果, 无需重新计算
+        :param duplicates: Dict[str, List[Tuple[str, float, int]]] 重复项字典
+        :param threshold: int 汉明距离阈值
+        :return: Dict[str, List[Tuple[str, float, int]]] 重复项字典
+        """
+        filtered = {}
+        for basePath, matches in duplicates.items():
+            matches = [match for match in matches if match[2] <= threshold]
+            if matches:
+                filtered[basePath] = matches
+        return filtered
@@ -5,24 +5,37 @@ from pathlib import Path
 from utils import showFile, showImage, logger
 from duplicatesFinder import DuplicateFinder
 
-from PySide6.QtCore import Signal, Qt, QMargins
+from PySide6.QtCore import Signal, Qt, QMargins, QTimer
 from PySide6.QtGui import QImage, QPixmap, QPainter, QPen, QColor
 from PySide6.QtWidgets import QVBoxLayout, QApplication, QFileDialog, QFrame, QWidget, QStackedWidget, QLabel, QTableWidgetItem, QHBoxLayout, QSplitter, \
     QTableWidget
-from qfluentwidgets import LineEdit, PushButton, MessageBox, TabBar, TabCloseButtonDisplayMode, FluentIcon, Icon, MSFluentTitleBar, CommandBarView, Action, \
-    FlyoutAnimationType, Flyout, TableWidget, IndeterminateProgressBar, CheckBox, ComboBox, FluentTranslator
+from qfluentwidgets import LineEdit, PlainTextEdit, PushButton, MessageBox, TabBar, TabCloseButtonDisplayMode, FluentIcon, Icon, MSFluentTitleBar, CommandBarView, Action, \
+    FlyoutAnimationType, Flyout, TableWidget, IndeterminateProgressBar, CheckBox, ComboBox, FluentTranslator, Slider, \
+    ToolButton, SpinBox, FlyoutViewBase
 from qfluentwidgets.components.widgets.frameless_window import FramelessWindow
 
 
 class DuplicateFinderUI(FramelessWindow):
-    signalPostProcess = Signal(object)
+    signalPostProcess = Signal(object, object)
     PHASH = "整体结构感知"
     DHASH = "纹理边缘差异"
     WHASH = "多维空间分析"
+    # 哈希算法, 哈希尺寸, 默认阈值
+    HASH_SETTINGS = {
+        PHASH: ("phash", 8, 12),
+        DHASH: ("dhash", 8, 10),
+        WHASH: ("whash", 8, 10)
+    }
 
     def __init__(self):
         super().__init__()
         self.duplicatesFinder = DuplicateFinder()
+        # 对比一次取最大半径内的结果并缓存距离, 阈值由滑块在结果中重新筛选
+        self.maxRadius = {"phash": 20, "dhash": 16, "whash": 16}
+        self.duplicates = {}
+        self.sourceRoots = None
+        self.resultSetting = None
+        self.pendingSetting = None
         self.highDpiScale = self.windowHandle().devicePixelRatio()
         self.signalPostProcess.connect(self.postprocess)
         self.__initUI()
@@ -72,9 +85,20 @@ class DuplicateFinderUI(FramelessWindow):
         bothLayout.addWidget(self.tarLineEdit)
         bothWidget.setLayout(bothLayout)
 
+        multiWidget = QWidget()
+        multiLayout = QVBoxLayout()
+        self.multiPathEdit = PathListEdit()
+        self.multiPathEdit.setPlaceholderText('图片目录, 每行一个(双击或拖入添加)')
+        self.intraMatchBox = CheckBox(self.tr("同时检查目录内重复"))
+        self.intraMatchBox.setChecked(False)
+        multiLayout.addWidget(self.multiPathEdit)
+        multiLayout.addWidget(self.intraMatchBox)
+        multiWidget.setLayout(multiLayout)
+
         self.pivotWidget = PivotWidget()
         self.pivotWidget.addWidget(singleWidget, 'dirLineEdit', '单目录', FluentIcon.FOLDER)
         self.pivotWidget.addWidget(bothWidget, 'bothLineEdit', '对比目录', FluentIcon.FOLDER_ADD)
+        self.pivotWidget.addWidget(multiWidget, 'multiPathEdit', '多目录', FluentIcon.LIBRARY)
         self.pivotWidget.setObjectName("inputPivot")
         self.pivotWidget.setStyleSheet(r"""#inputPivot{background-color: rgb(246, 246, 246);border-right: 1px solid rgba(0, 0, 0, 15)}""")
 
@@ -88,10 +112,17 @@ class DuplicateFinderUI(FramelessWindow):
         self.hashTypeBox = ComboBox()
         self.hashTypeBox.addItems([self.PHASH, self.DHASH, self.WHASH])
 
+        self.settingBtn = ToolButton(FluentIcon.SETTING)
+        self.settingBtn.clicked.connect(self.showSettingFlyout)
+
+        hashLayout = QHBoxLayout()
+        hashLayout.addWidget(self.hashTypeBox, stretch=1)
+        hashLayout.addWidget(self.settingBtn)
+
         controlPanel = QVBoxLayout()
         controlPanel.setContentsMargins(10, 5, 10, 5)
         controlPanel.addWidget(self.deepSeekBox)
-        controlPanel.addWidget(self.hashTypeBox)
+        controlPanel.addLayout(hashLayout)
         controlPanel.addWidget(self.startBtn)
         controlPanel.addWidget(self.progressBar)
 
@@ -129,7 +160,26 @@ class DuplicateFinderUI(FramelessWindow):
         self.tableFrame.currentCellChanged.connect(self.setCompareImage)
         self.tableFrame.setObjectName("TableFrame")
         self.tableFrame.setStyleSheet(self.tableFrame.styleSheet() + """\n#TableFrame{background-color: rgba(250, 250, 250, 200);}""")
-        return self.tableFrame
+
+        self.thresholdLabel = QLabel()
+        self.thresholdSlider = Slider(Qt.Orientation.Horizontal)
+        self.thresholdSlider.valueChanged.connect(self.onThresholdChanged)
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.setInterval(200)
+        self.refreshTimer.timeout.connect(self.refreshTable)
+
+        hbox = QHBoxLayout()
+        hbox.setContentsMargins(5, 0, 5, 0)
+        hbox.addWidget(self.thresholdLabel)
+        hbox.addWidget(self.thresholdSlider)
+
+        tableWidget = QWidget()
+        vbox = QVBoxLayout(tableWidget)
+        vbox.setContentsMargins(0, 0, 0, 0)
+        vbox.addLayout(hbox)
+        vbox.addWidget(self.tableFrame)
+        return tableWidget
 
     def setInputStatus(self, enable: bool):
         if enable:
@@ -138,10 +188,13 @@ class DuplicateFinderUI(FramelessWindow):
             self.progressBar.start()
         self.startBtn.setEnabled(enable)
         self.hashTypeBox.setEnabled(enable)
+        self.settingBtn.setEnabled(enable)
         self.deepSeekBox.setEnabled(enable)
         self.dirLineEdit.setEnabled(enable)
         self.srcLineEdit.setEnabled(enable)
         self.tarLineEdit.setEnabled(enable)
+        self.multiPathEdit.setEnabled(enable)
+        self.intraMatchBox.setEnabled(enable)
 
     def switchLayout(self, visible: bool):
         if visible:
@@ -153,16 +206,34 @@ class DuplicateFinderUI(FramelessWindow):
             self.resize(700, 235)
             self.splitFrame.setVisible(visible)
 
+    def showSettingFlyout(self):
+        view = SettingView(self)
+        view.addSpinBox("读取线程(机械硬盘/NAS建议1~2)", 1, 64, self.duplicatesFinder.ioWorkers,
+                        lambda value: setattr(self.duplicatesFinder, "ioWorkers", value))
+        view.addSpinBox("计算线程", 1, 256, self.duplicatesFinder.cpuWorkers,
+                        lambda value: setattr(self.duplicatesFinder, "cpuWorkers", value))
+        maxPendingBox = view.addSpinBox("内存缓冲图片数", 0, 4096, self.duplicatesFinder.maxPending or 0,
+                                        lambda value: setattr(self.duplicatesFinder, "maxPending", value or None))
+        maxPendingBox.setSpecialValueText("自动(计算线程×3)")
+        hashType, hashSize, _ = self.HASH_SETTINGS.get(self.hashTypeBox.currentText())
+        view.addSpinBox(f"{self.hashTypeBox.currentText()}最大半径", 1, hashSize ** 2, self.maxRadius[hashType],
+                        lambda value: self.onMaxRadiusChanged(hashType, value))
+        Flyout.make(view, self.settingBtn, self, FlyoutAnimationType.DROP_DOWN)
+
+    def onMaxRadiusChanged(self, hashType: str, value: int):
+        self.maxRadius[hashType] = value
+        # 当前结果覆盖的半径内可直接调整滑块范围, 更大的半径需重新对比
+        if self.resultSetting is not None and self.resultSetting[0] == hashType:
+            self.thresholdSlider.setMaximum(min(value, self.resultSetting[2]))
+
     def start(self):
         self.setInputStatus(False)
 
         currentName = self.pivotWidget.getCurrentWidgetObjectName()
         isDeepSeek = self.deepSeekBox.isChecked()
-        hashType, hashSize, threshold = {
-            self.PHASH: ("phash", 8, 12),
-            self.DHASH: ("dhash", 8, 10),
-            self.WHASH: ("whash", 8, 10)
-        }.get(self.hashTypeBox.currentText())
+        hashType, hashSize, threshold = self.HASH_SETTINGS.get(self.hashTypeBox.currentText())
+        maxRadius = self.maxRadius[hashType]
+        self.pendingSetting = (hashType, threshold, maxRadius)
 
         if currentName == "dirLineEdit":
             srcDir = self.dirLineEdit.getDirectory()
@@ -170,7 +241,7 @@ class DuplicateFinderUI(FramelessWindow):
                 self.showMsgDialog("提示", "找不到图片的目录路径(ノдヽ)")
                 self.setInputStatus(True)
                 return
-            _thread.start_new_thread(self.findDuplicate, (srcDir, hashType, hashSize, isDeepSeek, threshold, False))
+            _thread.start_new_thread(self.findDuplicate, (srcDir, hashType, hashSize, isDeepSeek, maxRadius, False))
 
         elif currentName == "bothLineEdit":
             srcDir = self.srcLineEdit.getDirectory()
@@ -179,57 +250,146 @@ class DuplicateFinderUI(FramelessWindow):
                 self.showMsgDialog("提示", "找不到图片的目录路径(°Д°)")
                 self.setInputStatus(True)
                 return
-            _thread.start_new_thread(self.findDuplicates, (srcDir, tarDir, hashType, hashSize, isDeepSeek, threshold))
+            _thread.start_new_thread(self.findDuplicates, (srcDir, tarDir, hashType, hashSize, isDeepSeek, maxRadius))
+
+        elif currentName == "multiPathEdit":
+            srcDirs = self.multiPathEdit.getDirectories()
+            if len(srcDirs) < 2 or not all(srcDir.exists() for srcDir in srcDirs):
+                self.showMsgDialog("提示", "至少需要两个存在的图片目录(・ω・)")
+                self.setInputStatus(True)
+                return
+            intraMatch = self.intraMatchBox.isChecked()
+            _thread.start_new_thread(self.findMultiDuplicates, (srcDirs, hashType, hashSize, isDeepSeek, maxRadius, intraMatch))
 
         else:
             pass
 
-    def findDuplicate(self, srcDir: str | Path, hashType: str, hashSize: int = 8, isDeepSeek: bool = False, threshold: int = 12, fullMatch: bool = False):
+    def findDuplicate(self, srcDir: str | Path, hashType: str, hashSize: int = 8, isDeepSeek: bool = False, maxRadius: int = 20, fullMatch: bool = False):
         try:
-            logger.info(f"开始{hashType} 检查[{srcDir}]目录下的图片.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, threshold:{threshold}")
-            srcHashes = self.duplicatesFinder.calcHashes(srcDir, hashType, hashSize, isDeepSeek)
-            duplicates = self.duplicatesFinder.findDuplicate(srcHashes, threshold, fullMatch)
-            self.signalPostProcess.emit(duplicates)
+            cacheKey = ("single", str(srcDir), hashType, hashSize, isDeepSeek, fullMatch)
+            pathList, _, fingerprint = self.duplicatesFinder.scanImages([srcDir], isDeepSeek)
+            duplicates = self.duplicatesFinder.getCachedResult(cacheKey, fingerprint, maxRadius)
+            if duplicates is not None:
+                logger.info(f"使用缓存的{hashType} 检查[{srcDir}]目录结果.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}")
+            else:
+                logger.info(f"开始{hashType} 检查[{srcDir}]目录下的图片.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}")
+                srcHashes = self.duplicatesFinder.calcPathHashes(pathList, hashType, hashSize)
+                duplicates = self.duplicatesFinder.findDuplicate(srcHashes, maxRadius, fullMatch)
+                self.duplicatesFinder.setCachedResult(cacheKey, fingerprint, maxRadius, duplicates)
+            self.signalPostProcess.emit(duplicates, None)
         except Exception as e:
             logger.exception(e)
             self.showMsgDialog("错误", "找不同时走神了...(-`д-´)")
 
-    def findDuplicates(self, srcDir: str | Path, tarDir: str | Path, hashType: str, hashSize: int = 8, isDeepSeek: bool = False, threshold: int = 12):
+    def findDuplicates(self, srcDir: str | Path, tarDir: str | Path, hashType: str, hashSize: int = 8, isDeepSeek: bool = False, maxRadius: int = 20):
         try:
-            logger.info(f"开始{hashType} 对比[{srcDir}]和[{tarDir}]目录下的图片.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, threshold:{threshold}")
-            srcHashes = self.duplicatesFinder.calcHashes(srcDir, hashType, hashSize, isDeepSeek)
-            tarHashes = self.duplicatesFinder.calcHashes(tarDir, hashType, hashSize, isDeepSeek)
-            duplicates = self.duplicatesFinder.findDuplicates(srcHashes, tarHashes, threshold)
-            self.signalPostProcess.emit(duplicates)
+            cacheKey = ("both", str(srcDir), str(tarDir), hashType, hashSize, isDeepSeek)
+            srcPathList, _, srcFingerprint = self.duplicatesFinder.scanImages([srcDir], isDeepSeek)
+            tarPathList, _, tarFingerprint = self.duplicatesFinder.scanImages([tarDir], isDeepSeek)
+            fingerprint = f"{srcFingerprint}|{tarFingerprint}"
+            duplicates = self.duplicatesFinder.getCachedResult(cacheKey, fingerprint, maxRadius)
+            if duplicates is not None:
+                logger.info(f"使用缓存的{hashType} 对比[{srcDir}]和[{tarDir}]目录结果.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}")
+            else:
+                logger.info(f"开始{hashType} 对比[{srcDir}]和[{tarDir}]目录下的图片.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}")
+                srcHashes = self.duplicatesFinder.calcPathHashes(srcPathList, hashType, hashSize)
+                tarHashes = self.duplicatesFinder.calcPathHashes(tarPathList, hashType, hashSize)
+                duplicates = self.duplicatesFinder.findDuplicates(srcHashes, tarHashes, maxRadius)
+                self.duplicatesFinder.setCachedResult(cacheKey, fingerprint, maxRadius, duplicates)
+            self.signalPostProcess.emit(duplicates, None)
+        except Exception as e:
+            logger.exception(e)
+            self.showMsgDialog("错误", "找不同时走神了...(-`д-´)")
+
+    def findMultiDuplicates(self, srcDirs: list, hashType: str, hashSize: int = 8, isDeepSeek: bool = False, maxRadius: int = 20, intraMatch: bool = False):
+        try:
+            dirNames = [str(srcDir) for srcDir in srcDirs]
+            cacheKey = ("multi", tuple(dirNames), hashType, hashSize, isDeepSeek, intraMatch)
+            pathList, pathRoots, fingerprint = self.duplicatesFinder.scanImages(srcDirs, isDeepSeek)
+            cached = self.duplicatesFinder.getCachedResult(cacheKey, fingerprint, maxRadius)
+            if cached is not None:
+                logger.info(f"使用缓存的{hashType} 对比{dirNames}目录结果.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}, intraMatch:{intraMatch}")
+                duplicates, sourceRoots = cached
+            else:
+                logger.info(f"开始{hashType} 对比{dirNames}目录下的图片.[hashSize:{hashSize}], isDeepSeek:{isDeepSeek}, maxRadius:{maxRadius}, intraMatch:{intraMatch}")
+                srcHashes = self.duplicatesFinder.calcPathHashes(pathList, hashType, hashSize)
+                sourceRoots = {path: pathRoots[path] for path in srcHashes}
+                duplicates = self.duplicatesFinder.findMultiDuplicates(srcHashes, sourceRoots, maxRadius, intraMatch)
+                self.duplicatesFinder.setCachedResult(cacheKey, fingerprint, maxRadius, (duplicates, sourceRoots))
+            self.signalPostProcess.emit(duplicates, sourceRoots)
         except Exception as e:
             logger.exception(e)
             self.showMsgDialog("错误", "找不同时走神了...(-`д-´)")
 
-    def postprocess(self, duplicates: dict):
+    def postprocess(self, duplicates: dict, sourceRoots: dict = None):
         self.setInputStatus(True)
+        self.duplicates = duplicates
+        self.sourceRoots = sourceRoots
+        # 同一哈希算法的结果保留已调好的阈值, 否则使用默认阈值
+        hashType, threshold, maxRadius = self.pendingSetting
+        if self.resultSetting is not None and self.resultSetting[0] == hashType:
+            threshold = self.thresholdSlider.value()
+        self.resultSetting = self.pendingSetting
+        self.thresholdSlider.blockSignals(True)
+        self.thresholdSlider.setRange(0, maxRadius)
+        self.thresholdSlider.setValue(min(threshold, maxRadius))
+        self.thresholdSlider.blockSignals(False)
+        self.thresholdLabel.setText(f"阈值: {self.thresholdSlider.value()}")
+
         if len(duplicates) <= 0:
+            self.refreshTable()
+            self.switchLayout(False)
             self.showMsgDialog("提示", "没找到重复的图片(￣ω￣)")
             return
+        elif len(self.duplicatesFinder.filterDuplicates(duplicates, self.thresholdSlider.value())) <= 0:
+            self.showMsgDialog("提示", "当前阈值下没有重复的图片, 拖动阈值滑块放宽试试(・ω・)")
         else:
             self.showMsgDialog("提示", "检查工作完成啦(￣▽￣)")
 
+        self.refreshTable()
+        if self.isMaximized():
+            self.showNormal()
+        self.switchLayout(True)
+        moveCenter(self)
+
+    def refreshTable(self):
+        """按当前阈值从缓存的对比结果中筛选表格数据"""
         sheet = []
         try:
+            duplicates = self.duplicatesFinder.filterDuplicates(self.duplicates, self.thresholdSlider.value())
             for srcPath, tarInfos in duplicates.items():
                 for nameInfo in tarInfos:
-                    sheet.append([srcPath, str(nameInfo[0]), f"{nameInfo[1] * 100}%"])
+                    row = [srcPath, str(nameInfo[0]), f"{nameInfo[1] * 100}%"]
+                    if self.sourceRoots is not None:
+                        row += [self.sourceRoots.get(srcPath, ""), self.sourceRoots.get(str(nameInfo[0]), "")]
+                    sheet.append(row)
             if len(sheet) > 1:
                 sheet = sorted(sheet, key=lambda x: float(x[2].rstrip('%')), reverse=True)
         except Exception as e:
             logger.exception(e)
             self.showMsgDialog("错误", "整理重复图片时眼花了...┐(・o・)┌")
 
-        self.tableFrame.setTableData(sheet, ["源图", '重图', '相似度'], [str(i) for i in range(1, len(sheet) + 1)])
-        if self.isMaximized():
-            self.showNormal()
-        self.switchLayout(True)
-        self.tableFrame.setCurrentCell(0, 0)
-        moveCenter(self)
+        # 筛选后仍存在的图片对保持选中, 避免重新加载图片
+        currentRow = self.tableFrame.currentRow()
+        currentPair = None
+        if 0 <= currentRow < self.tableFrame.rowCount():
+            currentPair = (self.tableFrame.item(currentRow, 0).text(), self.tableFrame.item(currentRow, 1).text())
+        keepRow = next((i for i, row in enumerate(sheet) if (row[0], row[1]) == currentPair), None)
+
+        horHeader = ["源图", '重图', '相似度'] if self.sourceRoots is None else ["源图", '重图', '相似度', '源图目录', '重图目录']
+        if keepRow is None:
+            self.tableFrame.setTableData(sheet, horHeader, [str(i) for i in range(1, len(sheet) + 1)])
+            self.tableFrame.setCurrentCell(0, 0)
+        else:
+            self.tableFrame.blockSignals(True)
+            self.tableFrame.setTableData(sheet, horHeader, [str(i) for i in range(1, len(sheet) + 1)])
+            self.tableFrame.setCurrentCell(keepRow, 0)
+            self.tableFrame.blockSignals(False)
+
+    def onThresholdChanged(self, value: int):
+        self.thresholdLabel.setText(f"阈值: {value}")
+        if self.duplicates:
+            self.refreshTimer.start()
 
     def setCompareImage(self, row, col=None):
         rowCount = self.tableFrame.rowCount()
@@ -240,6 +400,8 @@ class DuplicateFinderUI(FramelessWindow):
             self.tarImgFrame.setImage(tarPath)
 
     def onImageRemoved(self, text):
+        self.duplicates = {srcPath: [tarInfo for tarInfo in tarInfos if str(tarInfo[0]) != text]
+                           for srcPath, tarInfos in self.duplicates.items() if srcPath != text}
         self.tableFrame.delTableData(text)
         rowCount = self.tableFrame.rowCount()
         if rowCount <= 0:
@@ -366,6 +528,81 @@ class PathLineEdit(LineEdit):
             self.setText(str(path))
 
 
+class PathListEdit(PlainTextEdit):
+    def __init__(self):
+        super().__init__()
+        self.latestDir = None
+        self.setAcceptDrops(True)
+
+    def getDirectories(self) -> list[Path]:
+        """返回解析并去重后的目录, 相对路径和软链接指向同一目录时只保留一个"""
+        directories = []
+        for line in self.toPlainText().splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            directory = Path(line).resolve()
+            if directory not in directories:
+                directories.append(directory)
+        return directories
+
+    def addDirectory(self, fileDir: str | Path):
+        text = self.toPlainText().rstrip()
+        self.setPlainText(f"{text}\n{fileDir}" if text else str(fileDir))
+
+    def mouseDoubleClickEvent(self, event):
+        if event.button() != Qt.MouseButton.LeftButton:
+            return
+        self.choiceDirectory('选择目录')
+
+    def choiceDirectory(self, title: str):
+        if self.latestDir is None:
+            self.latestDir = Path.home()
+        fileDir = QFileDialog.getExistingDirectory(self.window(), title, str(self.latestDir), options=QFileDialog.Option.ShowDirsOnly)
+        if not fileDir:
+            return
+        self.latestDir = Path(fileDir)
+        self.addDirectory(fileDir)
+
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasUrls():
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+
+    def dragMoveEvent(self, event):
+        if event.mimeData().hasUrls():
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+
+    def dropEvent(self, event):
+        for url in event.mimeData().urls():
+            path = Path(url.toLocalFile())
+            if path.is_dir():
+                self.addDirectory(path)
+        event.acceptProposedAction()
+
+
+class SettingView(FlyoutViewBase):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.vBoxLayout = QVBoxLayout(self)
+        self.vBoxLayout.setContentsMargins(15, 10, 15, 10)
+
+    def addSpinBox(self, text: str, minimum: int, maximum: int, value: int, onChanged):
+        spinBox = SpinBox()
+        spinBox.setRange(minimum, maximum)
+        spinBox.setValue(value)
+        spinBox.valueChanged.connect(onChanged)
+
+        hbox = QHBoxLayout()
+        hbox.addWidget(QLabel(text), stretch=1)
+        hbox.addWidget(spinBox)
+        self.vBoxLayout.addLayout(hbox)
+        return spinBox
+
+
 class ImageFrame(CommonFrame):
     signalFileRemoved = Signal(str)
 